@@ -1,35 +1,176 @@
-import urllib.request
 import re
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import openpyxl
+from openpyxl.utils import get_column_letter
 import time
 import os
 import json
+import csv
+import atexit
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import urllib3
+from urllib3.util.request import ACCEPT_ENCODING
+from lxml import html as lxml_html
+from lxml.etree import ParserError
 import gspread
-from gspread.exceptions import WorksheetNotFound
+from gspread.exceptions import APIError, WorksheetNotFound
 from oauth2client.service_account import ServiceAccountCredentials
 
 BASE_DIR = os.path.dirname(__file__)
 SHEET_NAME = 'Amazon 売れ筋ランキング'
+# 設定するとブロックの中身や抽出結果などの詳細ログも出力する
+DEBUG = bool(os.environ.get('AMAZONRANKING_DEBUG'))
+# ランキングブロックとして扱う最大バイト数（実際のブロックは2KB未満）
+RANKING_BLOCK_LIMIT = 8192
+# Excelの列幅の上限
+MAX_COLUMN_WIDTH = 50
+# 取得時にストリームを読む単位
+READ_CHUNK_SIZE = 16384
+# 追記先のGoogleスプレッドシートID
+SPREADSHEET_ID = "1HwcDLMlm4rit3DYS2xQ4k4AwQgCAipSfiCiF_hGon_I"
+# 実行をまたいでGoogle APIのアクセストークンを使い回すためのキャッシュ
+# ホームディレクトリが残る環境向けで、AMAZONRANKING_TOKEN_CACHEを設定したときだけ使う
+# （GitHub Actionsでは実行ごとに消えるため既定ではトークンをディスクに書かない）
+TOKEN_CACHE = bool(os.environ.get('AMAZONRANKING_TOKEN_CACHE'))
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'amazonranking_token.json')
+
+# 一時的なエラー（429/5xx）はRetry-Afterまたは指数バックオフに従って再試行する
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Sheetsへの行の挿入は冪等でないため、書き込まれていないことが確実な429のときだけ再試行する
+# （5xxは書き込み後に返ることがあり、再送すると同じ行が2回挿入される）
+SHEETS_RETRY_STATUSES = [429]
+# Retry-Afterに従って待つ最大秒数（毎時の実行が長く止まらないようにする）
+MAX_RETRY_WAIT = 60
+# 再試行の設定を共有するためのコネクションプール
+# （取得は並列で行い、読み残した接続は閉じるため、接続の使い回しは起きない）
+HTTP = urllib3.PoolManager(
+    maxsize=4,
+    retries=urllib3.Retry(
+        total=5,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=1.0,
+        respect_retry_after_header=True,
+        allowed_methods=['GET'],
+    ),
+)
+
+# ランキングブロックの開始・終了マーカー（HTMLはバイト列のまま検索し、ブロックだけを復号する）
+_MARKERS = tuple(m.encode('utf-8') for m in ["Amazon 売れ筋ランキング:", "Amazon 売れ筋ランキング", "売れ筋ランキング:"])
+_END_MARKER = "カスタマーレビュー".encode('utf-8')
+# 下位カテゴリの順位はマーカー直後の<ul>にまとまっているため、その閉じタグで打ち切れる
+_LIST_END = b'</ul>'
+
+# --- ランキング抽出用の正規表現（呼び出しごとのコンパイルを避けるため事前にコンパイル） ---
+# リンクテキスト「(〜の売れ筋ランキングを見る)」だけをピンポイントで削除（手前の順位を消さない）
+# 半角・全角どちらの括弧でも1回の置換で消す
+_NOISE_RE = re.compile(r'[(（][^()（）]*?の売れ筋ランキングを見る[)）]')
+# パターン1: [カテゴリ名] - [順位位]
+# 使用される可能性のあるハイフン類: - (半角), − (マイナス), － (全角), — (エムダッシュ)
+# カテゴリ名はハイフン類を含まず前後が空白でない最長一致とし、非貪欲な量指定子による
+# 1文字ずつのバックトラックを避ける
+_NAME_RANK_RE = re.compile(r'([^\-−:：－—\s](?:[^\-−:：－—]{0,78}[^\-−:：－—\s])?)\s*[-−－—]\s*(\d{1,3}(?:,\d{3})*位)')
+# パターン2: [順位位] [カテゴリ名]
+_RANK_NAME_RE = re.compile(r'(\d{1,3}(?:,\d{3})*位)\s*([^\d\-−－—:：]{2,80})')
+_EMPTY_PAREN_RE = re.compile(r'\(\s*\)')
+# lxmlで解析できないブロック向けのタグ除去
+_TAG_RE = re.compile(r'<.*?>')
+
+# ログファイルは起動時に一度だけ開き、終了時に閉じる（並列取得中の書き込みはロックで直列化）
+# 書き込みはバッファにまとめ、終了時のcloseでまとめて書き出す
+# 開けない場合は画面出力だけで処理を続ける
+try:
+    _LOG_FH = open(os.path.join(BASE_DIR, 'amazonranking_log.txt'), 'a', encoding='utf-8', buffering=8192)
+    atexit.register(_LOG_FH.close)
+except OSError as e:
+    _LOG_FH = None
+    print(f"ログ書き込みエラー: {e}")
+_LOG_LOCK = threading.Lock()
 
 def log(msg):
     timestamp = time.strftime('%H:%M:%S')
     print(f"[{timestamp}] {msg}")
+    if _LOG_FH is None:
+        return
     try:
-        with open('amazonranking_log.txt', 'a', encoding='utf-8') as f:
-            f.write(f"[{timestamp}] {msg}\n")
+        with _LOG_LOCK:
+            _LOG_FH.write(f"[{timestamp}] {msg}\n")
     except Exception as e:
         print(f"ログ書き込みエラー: {e}")
 
-def extract_rankings_from_html(html, keyword, expected_len):
-    """Amazon商品ページのHTMLから売れ筋ランキング情報を抽出する。"""
+def debug(msg):
+    """詳細ログ。AMAZONRANKING_DEBUGが設定されているときだけ出力する。"""
+    if DEBUG:
+        log(msg)
+
+def _iter_rank_pairs(block):
+    """(カテゴリ名, 順位) の組を先頭から順に返す。パターン1に一致が無い場合のみパターン2を試す。"""
+    found = False
+    for m in _NAME_RANK_RE.finditer(block):
+        found = True
+        yield m.group(1), m.group(2)
+    if not found:
+        for m in _RANK_NAME_RE.finditer(block):
+            yield m.group(2), m.group(1)
+
+def _is_rank_number(s):
+    """「1,234」のようなカンマ区切りの順位の数字かどうか（パターン1の順位部分と同じ判定）。"""
+    head, *groups = s.split(',')
+    return (1 <= len(head) <= 3 and head.isdecimal()
+            and all(len(g) == 3 and g.isdecimal() for g in groups))
+
+def _scan_rank_pairs(block):
+    """「カテゴリ名 - 1,234位」が並ぶだけのブロック向けに、正規表現を使わず (カテゴリ名, 順位) の組を返す。
+
+    形の崩れた区間に出会った時点で打ち切る（件数が足りなければ呼び出し側で正規表現に切り替える）。
+    """
+    for seg in block.split('位')[:-1]:
+        h = max(seg.rfind(c) for c in '-−－—')
+        rank = seg[h + 1:].lstrip()
+        if h == -1 or not _is_rank_number(rank):
+            return
+        # カテゴリ名は直前の区切り文字より後ろ（パターン1のカテゴリ名と同じ文字制限）
+        name = seg[:h]
+        name = name[max(name.rfind(c) for c in '-−:：－—') + 1:].strip()
+        if not 1 <= len(name) <= 80:
+            return
+        yield name, rank + '位'
+
+def _collect_rankings(pairs, expected_len):
+    """(カテゴリ名, 順位) の組から不要なものを除き、最大expected_len件の表記を返す。
+
+    戻り値は (ランキングのリスト, 組が1つでもあったかどうか)。
+    """
     rankings = []
-    markers = ["Amazon 売れ筋ランキング:", "Amazon 売れ筋ランキング", "売れ筋ランキング:"]
+    matched = False
+    for name, rank in pairs:
+        matched = True
+        name = name.strip()
+        rank = rank.strip()
+        # 不要な単語が含まれる場合は除外
+        if "Amazon" in name or "見る" in name:
+            continue
+        text = f"{rank}{name}"
+        # 空の括弧の掃除は括弧を含む場合だけ正規表現を使う
+        if '(' in text:
+            text = _EMPTY_PAREN_RE.sub('', text)
+        rankings.append(text)
+        # 必要な件数が揃ったら残りは走査しない
+        if len(rankings) >= expected_len:
+            break
+    return rankings, matched
+
+def extract_rankings_from_html(html, keyword, expected_len, fast_scan=False):
+    """Amazon商品ページのHTML（UTF-8のバイト列）から売れ筋ランキング情報を抽出する。
+
+    fast_scanを指定すると、単純な形のブロックはまず正規表現を使わない走査で抽出する。
+    """
     start = -1
     used_marker = None
-    for m in markers:
+    for m in _MARKERS:
         start = html.find(m)
         if start != -1:
             used_marker = m
@@ -39,81 +180,171 @@ def extract_rankings_from_html(html, keyword, expected_len):
         return ['-'] * expected_len
 
     start = start + len(used_marker)
-    end = html.find("カスタマーレビュー", start)
+    # 正規表現処理の前にブロックを小さな範囲に絞り込む（終了マーカーの検索も範囲内に限定）
+    limit = start + RANKING_BLOCK_LIMIT
+    end = html.find(_END_MARKER, start, limit)
     if end == -1:
-        end = len(html)
-    block = html[start:end]
+        end = limit
+    list_end = html.find(_LIST_END, start, end)
+    if list_end != -1:
+        end = list_end
+    # 復号はブロックだけに行う（上限で切った場合は末尾の文字が欠けうるため置換する）
+    block = html[start:end].decode('utf-8', 'replace')
 
     # --- 修正箇所: クレンジング処理の最適化 ---
-    # 1. まずHTMLタグを除去
-    block = re.sub(r'<.*?>', '', block)
-    # 2. リンクテキスト「(〜の売れ筋ランキングを見る)」だけをピンポイントで削除（手前の順位を消さない）
-    block = re.sub(r'\([^()]*?の売れ筋ランキングを見る\)', '', block)
-    block = re.sub(r'\s+', ' ', block).strip()
-
-    # --- 修正箇所: 判定用ハイフンの種類を拡充 ---
-    # パターン1: [カテゴリ名] - [順位位]
-    # 使用される可能性のあるハイフン類: - (半角), − (マイナス), － (全角), — (エムダッシュ)
-    pattern_name_rank = r'([^\-:：－—]{2,80}?)\s*[-−－—]\s*(\d{1,3}(?:,\d{3})*位)'
-    # パターン2: [順位位] [カテゴリ名]
-    pattern_rank_name = r'(\d{1,3}(?:,\d{3})*位)\s*([^\d\-−－—:：]{2,80})'
-
-    matches = re.findall(pattern_name_rank, block)
-    
-    # パターン1で見つからない場合、逆の並び（パターン2）も試行
-    if not matches:
-        matches_alt = re.findall(pattern_rank_name, block)
-        matches = [(n.strip(), r.strip()) for r, n in matches_alt]
-
-    if not matches:
+    # 1. まずHTMLタグを除去（lxmlでテキストだけを取り出す。文字参照も復元される）
+    #    制御文字や<html>などを含みlxmlが解析できない場合は正規表現でタグだけを除く
+    try:
+        block = lxml_html.fragment_fromstring(block, create_parent='div').text_content()
+    except (ValueError, AssertionError, ParserError):
+        block = _TAG_RE.sub('', block)
+    # 2. 「(〜の売れ筋ランキングを見る)」を削除し、空白を詰める
+    #    固定文字列が無ければ正規表現を走らせない
+    if 'の売れ筋ランキングを見る' in block:
+        block = _NOISE_RE.sub('', block)
+    block = ' '.join(block.split())
+    debug(f"{keyword}処理前のブロック: {block[:200]}")
+
+    rankings, matched = _collect_rankings(_scan_rank_pairs(block), expected_len) if fast_scan else ([], False)
+    # 件数が足りない場合は正規表現で抽出し直す
+    if len(rankings) < expected_len:
+        rankings, matched = _collect_rankings(_iter_rank_pairs(block), expected_len)
+
+    if not matched:
         log(f"{keyword}ランキングパターンに一致なし")
         return ['-'] * expected_len
 
-    for name, rank in matches:
-        name = name.strip()
-        rank = rank.strip()
-        # 不要な単語が含まれる場合は除外
-        if "Amazon" in name or "見る" in name:
-            continue
-        text = f"{rank}{name}"
-        text = re.sub(r'\(\s*\)', '', text)
-        rankings.append(text)
-
     # 指定された数に調整
-    if len(rankings) < expected_len:
-        rankings += ['-'] * (expected_len - len(rankings))
-    else:
-        rankings = rankings[:expected_len]
+    rankings += ['-'] * (expected_len - len(rankings))
 
-    log(f"{keyword}ランキング抽出完了: {rankings}")
+    log(f"{keyword}ランキング抽出完了")
+    debug(f"{keyword}ランキング: {rankings}")
     return rankings
 
-def get_rankings_from_url(url, keyword, expected_len):
+def _read_until_ranking_block(res):
+    """レスポンスをチャンク単位で読み、ランキングブロックを読み終えた時点で打ち切る。"""
+    buf = bytearray()
+    marker = -1
+    while True:
+        chunk = res.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return bytes(buf)
+        prev_len = len(buf)
+        buf += chunk
+        if marker == -1:
+            marker = buf.find(_MARKERS[0], max(0, prev_len - len(_MARKERS[0]) + 1))
+            if marker == -1:
+                continue
+            prev_len = marker
+        # 抽出時と同じ範囲（</ul>か終了マーカーまで、または上限バイト数分）が揃えば残りは不要
+        body = marker + len(_MARKERS[0])
+        if (buf.find(_END_MARKER, max(body, prev_len - len(_END_MARKER) + 1)) != -1
+                or buf.find(_LIST_END, max(body, prev_len - len(_LIST_END) + 1), body + RANKING_BLOCK_LIMIT) != -1
+                or len(buf) >= body + RANKING_BLOCK_LIMIT):
+            return bytes(buf)
+
+def get_rankings_from_url(url, keyword, expected_len, fast_scan=False):
     """URLからHTMLを取得し、指定された件数のランキングを抽出して返す。"""
-    log(f"{keyword}ページ取得開始: {url}")
+    log(f"{keyword}ページ取得開始")
+    debug(f"{keyword}ページURL: {url}")
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req, timeout=15) as res:
-            html = res.read().decode('utf-8')
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            # 圧縮転送を要求（urllib3が展開できる形式のみ。brotli等が入っていればbrも含まれる）
+            'Accept-Encoding': ACCEPT_ENCODING,
+        }
+        r = HTTP.request('GET', url, headers=headers, timeout=15, preload_content=False)
+        try:
+            if r.status != 200:
+                raise urllib3.exceptions.HTTPError(f"HTTP {r.status}")
+            html = _read_until_ranking_block(r)
+        finally:
+            # 読み残しのある接続は閉じてから返す（最後まで読んだ接続は返却済み）
+            r.close()
+            r.release_conn()
         log(f"{keyword}ページ取得完了")
+        debug(f"{keyword}ページ読み込みサイズ: {len(html)} bytes")
+        # 抽出で例外が出ても他の取得対象の書き込みを止めない
+        return extract_rankings_from_html(html, keyword, expected_len, fast_scan)
     except Exception as e:
         log(f"{keyword}ページ取得エラー: {e}")
         return ['-'] * expected_len
-    return extract_rankings_from_html(html, keyword, expected_len)
 
-def save_to_excel_with_retry(excel_path, row_data, max_retries=3):
+def ranking_digest(row_data):
+    """時刻を除いたランキングの値のハッシュを返す。"""
+    return hashlib.blake2b(json.dumps(row_data[1:], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def load_cache(cache_path):
+    """実行をまたいで持ち越す状態を返す。
+
+    'digests' は書き込み先（'sheets'/'csv'）ごとに最後に書き込めたランキングのハッシュ、
+    'xlsx_date' は最後にExcelを作り直した日付（JST）。
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_cache(cache_path, cache):
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+
+def append_to_csv(csv_path, row_data, excel_path):
+    """CSV（履歴の正本）に1行追記する。CSVが未作成ならExcelの既存履歴から作成する。"""
+    if not os.path.exists(csv_path) and os.path.exists(excel_path):
+        wb = openpyxl.load_workbook(excel_path, read_only=True)
+        with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            if SHEET_NAME in wb.sheetnames:
+                for row in wb[SHEET_NAME].iter_rows(values_only=True):
+                    writer.writerow(['' if v is None else v for v in row])
+        wb.close()
+        log("ExcelからCSVを作成しました")
+    with open(csv_path, 'a', newline='', encoding='utf-8-sig') as f:
+        csv.writer(f).writerow(row_data)
+    log("CSV書き込み完了")
+
+def _widen(widths, row):
+    """行の値に合わせて列幅を広げる。上限に達した列は計測しない。"""
+    for i, v in enumerate(row, 1):
+        col = get_column_letter(i)
+        cur = widths.get(col, 0)
+        if cur < MAX_COLUMN_WIDTH:
+            widths[col] = min(max(cur, len(str(v)) + 2), MAX_COLUMN_WIDTH)
+
+def update_column_widths(widths_path, csv_path, row_data):
+    """列幅のキャッシュ（JSON）を追記した行で更新する。キャッシュが無ければCSVの全履歴から作る。"""
+    if os.path.exists(widths_path):
+        with open(widths_path, encoding='utf-8') as f:
+            widths = json.load(f)
+        _widen(widths, row_data)
+    else:
+        widths = {}
+        with open(csv_path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.reader(f):
+                _widen(widths, row)
+    with open(widths_path, 'w', encoding='utf-8') as f:
+        json.dump(widths, f, ensure_ascii=False, indent=2)
+
+def save_to_excel_with_retry(excel_path, csv_path, widths_path, max_retries=3):
+    """CSVの全履歴から1回の走査でExcelファイルを作り直す。列幅はキャッシュの値を使う。"""
+    widths = {}
+    if os.path.exists(widths_path):
+        with open(widths_path, encoding='utf-8') as f:
+            widths = json.load(f)
     for attempt in range(max_retries):
         try:
-            if os.path.exists(excel_path):
-                wb = openpyxl.load_workbook(excel_path)
-            else:
-                wb = openpyxl.Workbook()
-                if 'Sheet' in wb.sheetnames: wb.remove(wb['Sheet'])
-            if SHEET_NAME not in wb.sheetnames:
-                wb.create_sheet(SHEET_NAME)
-            ws = wb[SHEET_NAME]
-            ws.append(row_data)
+            # 書き込み専用モードで行をそのまま流し込む（セルオブジェクトを保持しない）
+            wb = openpyxl.Workbook(write_only=True)
+            ws = wb.create_sheet(SHEET_NAME)
+            # 書き込み専用シートでは列幅を行より先に設定する
+            for col, w in widths.items():
+                ws.column_dimensions[col].width = w
+            with open(csv_path, newline='', encoding='utf-8-sig') as f:
+                for row in csv.reader(f):
+                    ws.append([v if v != '' else None for v in row])
             wb.save(excel_path)
             log("Excel書き込み完了")
             return True
@@ -121,40 +352,162 @@ def save_to_excel_with_retry(excel_path, row_data, max_retries=3):
             time.sleep(5)
     return False
 
-def append_to_google_sheet(row_data):
-    creds_json = os.environ.get("GOOGLE_CREDENTIALS")
-    if not creds_json: return
-    scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+# 認証済みクライアントとワークシートは一度だけ作成して使い回す
+_GS_CLIENT = None
+_GS_WORKSHEET = None
+
+def _utcnow():
+    # google-authの有効期限はタイムゾーン情報を持たないUTC
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def _load_cached_token(auth, fingerprint):
+    """前回保存したアクセストークンが同じ認証情報のもので有効期限内なら設定する（トークン交換を省く）。"""
+    try:
+        with open(TOKEN_CACHE_PATH, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['fingerprint'] != fingerprint:
+            return
+        expiry = datetime.datetime.fromisoformat(cached['expiry'])
+    except (OSError, ValueError, KeyError):
+        return
+    if expiry > _utcnow() + datetime.timedelta(seconds=60):
+        auth.token = cached['token']
+        auth.expiry = expiry
+        log("キャッシュ済みのアクセストークンを使用します")
+
+def _save_token(auth, fingerprint):
+    """取得済みのアクセストークンを本人だけが読めるファイルに保存する。"""
+    if not auth.token or not auth.expiry:
+        return
     try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+        fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': fingerprint, 'token': auth.token, 'expiry': auth.expiry.isoformat()}, f)
+    except OSError as e:
+        log(f"アクセストークン保存エラー: {e}")
+
+def _get_gs_client(creds_json):
+    global _GS_CLIENT
+    if _GS_CLIENT is None:
+        scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
         info = json.loads(creds_json)
         creds = ServiceAccountCredentials.from_json_keyfile_dict(info, scope)
-        client = gspread.authorize(creds)
-        # 指定されたスプレッドシートID
-        SPREADSHEET_ID = "1HwcDLMlm4rit3DYS2xQ4k4AwQgCAipSfiCiF_hGon_I"
-        workbook = client.open_by_key(SPREADSHEET_ID)
-        worksheet = workbook.worksheet(SHEET_NAME)
-        worksheet.append_row(row_data, value_input_option='USER_ENTERED')
-        worksheet.sort((1, 'des'))
+        _GS_CLIENT = gspread.authorize(creds)
+        if TOKEN_CACHE:
+            # トークンは認証情報ごとに保存し、終了時にその時点のトークンを書き戻す
+            fingerprint = hashlib.sha256(f"{info.get('client_email')}:{info.get('private_key_id')}".encode('utf-8')).hexdigest()
+            auth = _GS_CLIENT.http_client.auth
+            _load_cached_token(auth, fingerprint)
+            atexit.register(_save_token, auth, fingerprint)
+    return _GS_CLIENT
+
+def _get_gs_worksheet(creds_json):
+    global _GS_WORKSHEET
+    if _GS_WORKSHEET is None:
+        workbook = _get_gs_client(creds_json).open_by_key(SPREADSHEET_ID)
+        try:
+            _GS_WORKSHEET = workbook.worksheet(SHEET_NAME)
+        except WorksheetNotFound:
+            log(f"ワークシート {SHEET_NAME} が見つかりません")
+    return _GS_WORKSHEET
+
+def _call_with_backoff(func, *args, max_retries=5, **kwargs):
+    """Sheets APIのレート制限（429）をRetry-After（無ければ指数バックオフ）に従って再試行する。"""
+    for attempt in range(max_retries):
+        try:
+            return func(*args, **kwargs)
+        except APIError as e:
+            status = e.response.status_code
+            if status not in SHEETS_RETRY_STATUSES or attempt == max_retries - 1:
+                raise
+            retry_after = e.response.headers.get('Retry-After')
+            wait = int(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+            wait = min(wait, MAX_RETRY_WAIT)
+            log(f"Googleスプレッドシート {status} エラー: {wait}秒後に再試行 ({attempt + 1}/{max_retries})")
+            time.sleep(wait)
+
+def _insert_rows_at_top(worksheet, rows):
+    """ヘッダー直下への行の挿入と値の書き込みを1回のbatchUpdateで行う（値はRAWと同じく文字列のまま）。"""
+    body = {
+        'requests': [
+            {'insertDimension': {
+                'range': {'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': 1, 'endIndex': 1 + len(rows)},
+                'inheritFromBefore': False,
+            }},
+            {'updateCells': {
+                'start': {'sheetId': worksheet.id, 'rowIndex': 1, 'columnIndex': 0},
+                'rows': [{'values': [{'userEnteredValue': {'stringValue': str(v)}} for v in row]} for row in rows],
+                'fields': 'userEnteredValue',
+            }},
+        ]
+    }
+    return worksheet.spreadsheet.batch_update(body)
+
+def append_to_google_sheet(rows):
+    """行のリストを新しいもの順でシートの先頭（ヘッダー直下）に書き込む。書き込めたらTrueを返す。"""
+    creds_json = os.environ.get("GOOGLE_CREDENTIALS")
+    if not creds_json: return False
+    try:
+        worksheet = _get_gs_worksheet(creds_json)
+        if worksheet is None: return False
+        # 新しい行をヘッダー直下に挿入して降順を保つ（sortの再書き込みを不要にする）
+        _call_with_backoff(_insert_rows_at_top, worksheet, rows)
         log("Googleスプレッドシートに追記完了")
+        return True
     except Exception as e:
         log(f"Googleスプレッドシートエラー: {e}")
+        return False
 
 # --- メイン処理 ---
 log("処理開始")
-JST = pytz.timezone('Asia/Tokyo')
-now = datetime.datetime.now(JST).replace(minute=0, second=0, microsecond=0).strftime('%Y/%m/%d %H:%M')
-
-# URL設定
-normal_url = 'https://www.amazon.co.jp/gp/product/4798183180/'
-kindle_url = 'https://www.amazon.co.jp/gp/product/B0CYPMKYM3/'
-audible_url = 'https://www.amazon.co.jp/gp/product/B0G66DNXDH/'
+JST = ZoneInfo('Asia/Tokyo')
+now_dt = datetime.datetime.now(JST).replace(minute=0, second=0, microsecond=0)
+now = now_dt.strftime('%Y/%m/%d %H:%M')
 
-normal_rankings = get_rankings_from_url(normal_url, '紙書籍', expected_len=4)
-kindle_rankings = get_rankings_from_url(kindle_url, 'Kindle', expected_len=2)
-audible_rankings = get_rankings_from_url(audible_url, 'Audible', expected_len=4)
+# 取得対象（URL, 種別, 取得件数, 正規表現を使わない走査を先に試すか）。行データの列はこの順に並ぶ
+# 紙書籍はカテゴリ数が変わりやすいため正規表現のみで抽出する
+TARGETS = [
+    ('https://www.amazon.co.jp/gp/product/4798183180/', '紙書籍', 4, False),
+    ('https://www.amazon.co.jp/gp/product/B0CYPMKYM3/', 'Kindle', 2, True),
+    ('https://www.amazon.co.jp/gp/product/B0G66DNXDH/', 'Audible', 4, True),
+]
 
-row_data = [now] + normal_rankings + kindle_rankings + audible_rankings
-append_to_google_sheet(row_data)
+# 全ページを並列に取得する（結果はTARGETSの順序で受け取る）
+with ThreadPoolExecutor(max_workers=len(TARGETS)) as ex:
+    futures = [ex.submit(get_rankings_from_url, *target) for target in TARGETS]
+    row_data = [now]
+    for f in futures:
+        row_data += f.result()
 excel_path = os.path.join(BASE_DIR, 'amazonranking_matome.xlsx')
-save_to_excel_with_retry(excel_path, row_data)
+csv_path = os.path.join(BASE_DIR, 'amazonranking_matome.csv')
+widths_path = os.path.join(BASE_DIR, 'amazonranking_widths.json')
+cache_path = os.path.join(BASE_DIR, '.amazonranking_cache.json')
+
+# 前回書き込めたランキングから変わっていなければ書き込みを省く（Sheetsの書き込み枠を節約する）
+# ハッシュは書き込み先ごとに持ち、書き込めた直後に保存する（失敗した先は次回また書き込み、
+# 後続の書き込みが失敗しても書き込み済みの先へ同じ行を重ねて書かない）
+digest = ranking_digest(row_data)
+cache = load_cache(cache_path)
+digests = cache.setdefault('digests', {})
+if digests.get('sheets') == digest:
+    log("ランキングに変化が無いためGoogleスプレッドシートへの書き込みをスキップします")
+elif append_to_google_sheet([row_data]):
+    digests['sheets'] = digest
+    save_cache(cache_path, cache)
+if digests.get('csv') == digest:
+    log("ランキングに変化が無いためCSVへの書き込みをスキップします")
+else:
+    append_to_csv(csv_path, row_data, excel_path)
+    digests['csv'] = digest
+    save_cache(cache_path, cache)
+    update_column_widths(widths_path, csv_path, row_data)
+    debug(f"書き込んだ行データ: {row_data}")
+# Excelの作り直しはその日（JST）の最初の実行で1回か、環境変数で明示された場合のみ
+# （0時台の実行が遅延・欠落しても、その日のうちに次の実行で作り直される）
+today = now_dt.date().isoformat()
+if cache.get('xlsx_date') != today or os.environ.get("AMAZONRANKING_EXPORT_XLSX"):
+    if save_to_excel_with_retry(excel_path, csv_path, widths_path):
+        cache['xlsx_date'] = today
+        save_cache(cache_path, cache)
 log("処理完了")